@@ -1,28 +1,104 @@
+import asyncio
+import hashlib
+import logging
+
 from pydantic import BaseModel, EmailStr
-from fastapi import FastAPI, HTTPException, Query, status
-from tortoise import Tortoise, fields
+import bcrypt
+from fastapi import Body, FastAPI, HTTPException, Query, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.redis import RedisBackend
+from fastapi_cache.decorator import cache
+from redis import asyncio as aioredis
+from tortoise import Tortoise, connections, fields, timezone
 from tortoise.contrib.fastapi import register_tortoise
+from tortoise.contrib.pydantic import PydanticListModel, pydantic_model_creator, pydantic_queryset_creator
 from tortoise.models import Model
-from typing import List
+from tortoise.queryset import QuerySet
+from tortoise.transactions import in_transaction
+from typing import Generic, List, Optional, Type, TypeVar
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-# Функция для инициализации и подключения к базе данных
-async def init():
-    await Tortoise.init(
-        db_url='sqlite://db.sqlite3',
-        modules={'models': ['main']},
+# Размер пачки для bulk_create: держимся ниже лимита SQLite в 999 параметров
+BULK_BATCH_SIZE = 500
+# Ограничение размера одного bulk-запроса, чтобы он не занимал воркер надолго
+BULK_MAX_ITEMS = BULK_BATCH_SIZE * 4
+
+# Кэш GET-роутов в Redis
+REDIS_URL = "redis://localhost"
+CACHE_EXPIRE = 60
+
+# Поля, по которым разрешена сортировка товаров
+SORT_FIELDS = frozenset({"price", "name", "id"})
+
+# Конфигурация Tortoise. Неизвестные бэкенду параметры credentials SQLite
+# выполняются как PRAGMA при открытии соединения: WAL-журнал и ослабленная
+# синхронизация вместо fsync на каждую транзакцию
+TORTOISE_ORM = {
+    "connections": {
+        "default": {
+            "engine": "tortoise.backends.sqlite",
+            "credentials": {
+                "file_path": "db.sqlite3",
+                "journal_mode": "WAL",
+                "synchronous": "NORMAL",
+                "temp_store": "MEMORY",
+                "cache_size": -64000,
+                "mmap_size": 268435456,
+            },
+        },
+    },
+    "apps": {
+        "models": {
+            "models": ["main"],
+            "default_connection": "default",
+        },
+    },
+}
+
+# Индексы по внешним ключам заказов. Создаются при старте, чтобы появиться
+# и в уже существующей базе, где generate_schemas их не добавит.
+# Составной индекс покрывает и выборки только по user_id.
+ORDER_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_order_user_product ON "order"(user_id, product_id);
+CREATE INDEX IF NOT EXISTS idx_order_product ON "order"(product_id);
+"""
+
+# bcrypt учитывает только первые 72 байта пароля; новые версии пакета
+# требуют обрезать их явно. Хэширование занимает сотни миллисекунд,
+# поэтому из обработчиков оно вызывается через run_in_threadpool
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode()[:72], bcrypt.gensalt()).decode()
+
+# bcrypt отпускает GIL, поэтому пароли хэшируются параллельно в пуле потоков
+async def hash_passwords(passwords: List[str]) -> List[str]:
+    return await asyncio.gather(*(run_in_threadpool(hash_password, password) for password in passwords))
+
+# Пароли, сохраненные открытым текстом до перехода на bcrypt, хэшируются при старте
+async def hash_legacy_passwords():
+    conn = connections.get('default')
+    rows = await conn.execute_query_dict(
+        'SELECT id, password FROM "user" WHERE password NOT LIKE ?', ["$2%"]
+    )
+    if not rows:
+        return
+    hashes = await hash_passwords([row["password"] for row in rows])
+    await conn.execute_many(
+        'UPDATE "user" SET password = ? WHERE id = ?',
+        [[hashed, row["id"]] for hashed, row in zip(hashes, rows)],
     )
-    await Tortoise.generate_schemas()
-
-# Событийный цикл для вызова асинхронных функций
-@app.on_event("startup")
-async def startup_event():
-    await init()
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    await Tortoise.close_connections()
+# Сброс кэша после записи. Данные к этому моменту уже сохранены, поэтому
+# недоступный Redis не должен превращать успешную запись в ошибку 500
+async def clear_cache(*namespaces: str) -> None:
+    for namespace in namespaces:
+        try:
+            await FastAPICache.clear(namespace=namespace)
+        except Exception:
+            logger.warning("Error clearing cache namespace %s", namespace, exc_info=True)
 
 # Модели Pydantic для валидации данных
 class UserCreate(BaseModel):
@@ -31,35 +107,16 @@ class UserCreate(BaseModel):
     email: EmailStr
     password: str
 
-class UserPydantic(BaseModel):
-    id: int
-    first_name: str
-    last_name: str
-    email: EmailStr
-
 class ProductCreate(BaseModel):
     name: str
     description: str
     price: float
 
-class ProductPydantic(BaseModel):
-    id: int
-    name: str
-    description: str
-    price: float
-
 class OrderCreate(BaseModel):
     user_id: int
     product_id: int
     status: str
 
-class OrderPydantic(BaseModel):
-    id: int
-    user_id: int
-    product_id: int
-    order_date: str
-    status: str
-
 # Модели 
 class User(Model):
     id = fields.IntField(pk=True)
@@ -67,12 +124,18 @@ class User(Model):
     last_name = fields.CharField(max_length=255)
     email = fields.CharField(max_length=255)
     password = fields.CharField(max_length=255)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    # Хэш пароля не отдается в ответах API
+    class PydanticMeta:
+        exclude = ("password",)
 
 class Product(Model):
     id = fields.IntField(pk=True)
     name = fields.CharField(max_length=255)
     description = fields.TextField()
-    price = fields.FloatField()
+    price = fields.FloatField(db_index=True)
+    updated_at = fields.DatetimeField(auto_now=True)
 
 class Order(Model):
     id = fields.IntField(pk=True)
@@ -80,16 +143,86 @@ class Order(Model):
     product = fields.ForeignKeyField('models.Product', related_name='orders')
     order_date = fields.DatetimeField(auto_now_add=True)
     status = fields.CharField(max_length=255)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+# Pydantic-модели строятся из моделей Tortoise один раз при импорте.
+# init_models нужен заранее, чтобы разрешились связи ForeignKey.
+Tortoise.init_models(["main"], "models")
+
+UserPyd = pydantic_model_creator(User, name="UserPyd", exclude=("orders",))
+ProductPyd = pydantic_model_creator(Product, name="ProductPyd", exclude=("orders",))
+OrderPyd = pydantic_model_creator(Order, name="OrderPyd", exclude=("user", "product"))
+
+UserPydList = pydantic_queryset_creator(User, name="UserPydList", exclude=("orders",))
+ProductPydList = pydantic_queryset_creator(Product, name="ProductPydList", exclude=("orders",))
+OrderPydList = pydantic_queryset_creator(Order, name="OrderPydList", exclude=("user", "product"))
 
 # Регистрация моделей
 register_tortoise(
     app,
-    db_url='sqlite://db.sqlite3',
-    modules={'models': ['main']},
+    config=TORTOISE_ORM,
     generate_schemas=True,
     add_exception_handlers=True,
 )
 
+# Колонка updated_at появилась позже таблиц; generate_schemas не меняет
+# существующие таблицы, поэтому в старую базу она добавляется при старте.
+# SQLite не разрешает ADD COLUMN с DEFAULT CURRENT_TIMESTAMP, так что
+# значение для старых строк проставляется отдельным UPDATE.
+async def add_updated_at_columns():
+    conn = connections.get('default')
+    for table in ("user", "product", "order"):
+        columns = await conn.execute_query_dict(f'PRAGMA table_info("{table}")')
+        if not any(column["name"] == "updated_at" for column in columns):
+            await conn.execute_script(
+                f'ALTER TABLE "{table}" ADD COLUMN "updated_at" TIMESTAMP;'
+                f'UPDATE "{table}" SET "updated_at" = CURRENT_TIMESTAMP;'
+            )
+
+# Обработчик объявлен после register_tortoise: startup-события выполняются
+# в порядке регистрации, и к этому моменту подключение уже открыто
+@app.on_event("startup")
+async def startup_event():
+    await add_updated_at_columns()
+    await connections.get('default').execute_script(ORDER_INDEXES)
+    await hash_legacy_passwords()
+    FastAPICache.init(RedisBackend(aioredis.from_url(REDIS_URL)), prefix="gb")
+
+# Курсорная пагинация списков: выборка по индексу первичного ключа
+# вместо OFFSET, который заставляет SQLite пропускать строки
+PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 500
+
+ItemT = TypeVar("ItemT")
+
+class Page(BaseModel, Generic[ItemT]):
+    items: List[ItemT]
+    next_cursor: Optional[int] = None
+
+async def paginate(
+    pyd_list: Type[PydanticListModel], queryset: QuerySet, limit: int, after_id: Optional[int]
+) -> dict:
+    if after_id is not None:
+        queryset = queryset.filter(id__gt=after_id)
+    items = (await pyd_list.from_queryset(queryset.order_by("id").limit(limit))).root
+    next_cursor = items[-1].id if len(items) == limit else None
+    return {"items": items, "next_cursor": next_cursor}
+
+# ETag строки: меняется при каждом сохранении записи
+def make_etag(obj: Model) -> str:
+    digest = hashlib.md5(f"{obj.id}:{obj.updated_at.timestamp()}".encode()).hexdigest()
+    return f'"{digest}"'
+
+# Проверка If-None-Match по RFC 7232: слабое сравнение (префикс W/
+# игнорируется), список тегов через запятую и "*"
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in {tag.strip().removeprefix("W/") for tag in header.split(",")}
+
 class UserUpdate(BaseModel):
     first_name: str = None
     last_name: str = None
@@ -107,73 +240,181 @@ class OrderUpdate(BaseModel):
     status: str = None
 
 # Роуты для CRUD операций
-@app.post("/users/", response_model=UserPydantic)
+@app.post("/users/", response_model=UserPyd)
 async def create_user(user: UserCreate):
-    user_obj = await User.create(**user.dict())
-    return await UserPydantic.from_tortoise_orm(user_obj)
-
-@app.get("/users/{user_id}", response_model=UserPydantic)
-async def read_user(user_id: int):
-    user = await User.get(id=user_id)
-    if not user:
+    password = await run_in_threadpool(hash_password, user.password)
+    user_obj = await User.create(**user.dict(exclude={"password"}), password=password)
+    return await UserPyd.from_tortoise_orm(user_obj)
+
+@app.post("/users/bulk/", response_model=dict)
+async def create_users_bulk(users: List[UserCreate] = Body(..., max_length=BULK_MAX_ITEMS)):
+    passwords = await hash_passwords([user.password for user in users])
+    async with in_transaction() as conn:
+        await User.bulk_create(
+            [
+                User(**user.dict(exclude={"password"}), password=password)
+                for user, password in zip(users, passwords)
+            ],
+            batch_size=BULK_BATCH_SIZE,
+            using_db=conn,
+        )
+    return {"created": len(users)}
+
+@app.get("/users/{user_id}", response_model=UserPyd)
+async def read_user(user_id: int, request: Request, response: Response):
+    user = await User.get_or_none(id=user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    etag = make_etag(user)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return await UserPyd.from_tortoise_orm(user)
+
+@app.put("/users/{user_id}", response_model=UserPyd)
+async def update_user(user_id: int, user: UserUpdate):
+    payload = user.dict(exclude_unset=True)
+    if not payload:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    if "password" in payload:
+        payload["password"] = await run_in_threadpool(hash_password, payload["password"])
+    # Один UPDATE без предварительного SELECT; updated_at выставляем сами,
+    # так как QuerySet.update не трогает поля auto_now
+    updated = await User.filter(id=user_id).update(**payload, updated_at=timezone.now())
+    if not updated:
         raise HTTPException(status_code=404, detail="User not found")
-    return await UserPydantic.from_tortoise_orm(user)
+    return await UserPyd.from_queryset_single(User.get(id=user_id))
 
-@app.post("/products/", response_model=ProductPydantic)
+@app.post("/products/", response_model=ProductPyd)
 async def create_product(product: ProductCreate):
     product_obj = await Product.create(**product.dict())
-    return await ProductPydantic.from_tortoise_orm(product_obj)
-
-@app.get("/products/{product_id}", response_model=ProductPydantic)
-async def read_product(product_id: int):
-    product = await Product.get(id=product_id)
-    if not product:
+    await clear_cache("products")
+    return await ProductPyd.from_tortoise_orm(product_obj)
+
+@app.post("/products/bulk/", response_model=dict)
+async def create_products_bulk(products: List[ProductCreate] = Body(..., max_length=BULK_MAX_ITEMS)):
+    async with in_transaction() as conn:
+        await Product.bulk_create(
+            [Product(**product.dict()) for product in products],
+            batch_size=BULK_BATCH_SIZE,
+            using_db=conn,
+        )
+    await clear_cache("products")
+    return {"created": len(products)}
+
+@app.get("/products/{product_id}", response_model=ProductPyd)
+async def read_product(product_id: int, request: Request, response: Response):
+    product = await Product.get_or_none(id=product_id)
+    if product is None:
         raise HTTPException(status_code=404, detail="Product not found")
-    return await ProductPydantic.from_tortoise_orm(product)
+    etag = make_etag(product)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return await ProductPyd.from_tortoise_orm(product)
+
+@app.put("/products/{product_id}", response_model=ProductPyd)
+async def update_product(product_id: int, product: ProductUpdate):
+    payload = product.dict(exclude_unset=True)
+    if not payload:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    updated = await Product.filter(id=product_id).update(**payload, updated_at=timezone.now())
+    if not updated:
+        raise HTTPException(status_code=404, detail="Product not found")
+    # Цена товара входит в суммы заказов
+    await clear_cache("products", "orders")
+    return await ProductPyd.from_queryset_single(Product.get(id=product_id))
 
-@app.post("/orders/", response_model=OrderPydantic)
+@app.post("/orders/", response_model=OrderPyd)
 async def create_order(order: OrderCreate):
     order_obj = await Order.create(**order.dict())
-    return await OrderPydantic.from_tortoise_orm(order_obj)
+    await clear_cache("orders")
+    return await OrderPyd.from_tortoise_orm(order_obj)
+
+@app.post("/orders/bulk/", response_model=dict)
+async def create_orders_bulk(orders: List[OrderCreate] = Body(..., max_length=BULK_MAX_ITEMS)):
+    # Проверяем существование пользователей и товаров одним запросом на таблицу
+    user_ids = {order.user_id for order in orders}
+    product_ids = {order.product_id for order in orders}
+    found_users = set(await User.filter(id__in=user_ids).values_list('id', flat=True))
+    if user_ids - found_users:
+        raise HTTPException(status_code=404, detail="User not found")
+    found_products = set(await Product.filter(id__in=product_ids).values_list('id', flat=True))
+    if product_ids - found_products:
+        raise HTTPException(status_code=404, detail="Product not found")
 
-@app.get("/orders/{order_id}", response_model=OrderPydantic)
-async def read_order(order_id: int):
-    order = await Order.get(id=order_id)
-    if not order:
+    async with in_transaction() as conn:
+        await Order.bulk_create(
+            [Order(**order.dict()) for order in orders],
+            batch_size=BULK_BATCH_SIZE,
+            using_db=conn,
+        )
+    await clear_cache("orders")
+    return {"created": len(orders)}
+
+@app.get("/orders/{order_id}", response_model=OrderPyd)
+async def read_order(order_id: int, request: Request, response: Response):
+    order = await Order.get_or_none(id=order_id)
+    if order is None:
         raise HTTPException(status_code=404, detail="Order not found")
-    return await OrderPydantic.from_tortoise_orm(order)
-
-@app.get("/users/", response_model=List[UserPydantic])
-async def list_users():
-    users = await User.all()
-    return [await UserPydantic.from_tortoise_orm(user) for user in users]
+    etag = make_etag(order)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return await OrderPyd.from_tortoise_orm(order)
+
+@app.put("/orders/{order_id}", response_model=OrderPyd)
+async def update_order(order_id: int, order: OrderUpdate):
+    payload = order.dict(exclude_unset=True)
+    if not payload:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    updated = await Order.filter(id=order_id).update(**payload, updated_at=timezone.now())
+    if not updated:
+        raise HTTPException(status_code=404, detail="Order not found")
+    await clear_cache("orders")
+    return await OrderPyd.from_queryset_single(Order.get(id=order_id))
 
-@app.get("/products/", response_model=List[ProductPydantic])
-async def list_products():
-    products = await Product.all()
-    return [await ProductPydantic.from_tortoise_orm(product) for product in products]
+@app.get("/users/", response_model=Page[UserPyd])
+async def list_users(
+    limit: int = Query(PAGE_LIMIT, gt=0, le=MAX_PAGE_LIMIT, description="Page size"),
+    after_id: Optional[int] = Query(None, ge=0, description="Cursor: last id of the previous page"),
+):
+    queryset = User.all().only("id", "first_name", "last_name", "email", "updated_at")
+    return await paginate(UserPydList, queryset, limit, after_id)
+
+@app.get("/products/", response_model=Page[ProductPyd])
+@cache(expire=CACHE_EXPIRE, namespace="products")
+async def list_products(
+    limit: int = Query(PAGE_LIMIT, gt=0, le=MAX_PAGE_LIMIT, description="Page size"),
+    after_id: Optional[int] = Query(None, ge=0, description="Cursor: last id of the previous page"),
+):
+    return await paginate(ProductPydList, Product.all(), limit, after_id)
 
-@app.get("/users/{user_id}/orders/", response_model=List[OrderPydantic])
+@app.get("/users/{user_id}/orders/", response_model=OrderPydList)
 async def list_user_orders(user_id: int):
-    user = await User.get(id=user_id)
-    if not user:
+    if not await User.exists(id=user_id):
         raise HTTPException(status_code=404, detail="User not found")
 
-    orders = await Order.filter(user=user)
-    return [await OrderPydantic.from_tortoise_orm(order) for order in orders]
+    # from_queryset сам подгружает связи, описанные в OrderPydList, одним запросом
+    # на связь. Сейчас user и product исключены, поэтому лишних запросов нет;
+    # явный prefetch_related понадобится только для связей вне Pydantic-модели.
+    return await OrderPydList.from_queryset(Order.filter(user_id=user_id))
 
 # Роут для подсчета общей суммы заказов пользователя
 @app.get("/users/{user_id}/total-order-amount/", response_model=dict)
+@cache(expire=CACHE_EXPIRE, namespace="orders")
 async def total_order_amount(user_id: int):
-    user = await User.get(id=user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    total_amount = await Order.filter(user=user).aggregate(fields.Sum('product__price'))
-    return {"total_amount": total_amount["product__price__sum"] or 0}
+    # Один агрегирующий запрос с JOIN вместо проверки пользователя и отдельного SUM
+    rows = await connections.get('default').execute_query_dict(
+        'SELECT COALESCE(SUM(p.price), 0) AS total FROM "order" o '
+        'JOIN product p ON o.product_id = p.id WHERE o.user_id = ?',
+        [user_id],
+    )
+    return {"total_amount": rows[0]["total"]}
 
 # Роут для сортировки и фильтрации товаров
-@app.get("/products/sorted/", response_model=List[ProductPydantic])
+@app.get("/products/sorted/", response_model=ProductPydList)
+@cache(expire=CACHE_EXPIRE, namespace="products")
 async def list_sorted_products(
     min_price: float = Query(None, gt=0, description="Minimum price filter"),
     max_price: float = Query(None, gt=0, description="Maximum price filter"),
@@ -187,13 +428,15 @@ async def list_sorted_products(
     if max_price is not None:
         query = query.filter(price__lte=max_price)
     if sort_by:
-        query = query.order_by(f"{sort_by} DESC" if sort_by and desc else f"{sort_by}")
+        if sort_by not in SORT_FIELDS:
+            raise HTTPException(status_code=400, detail="Invalid sort field")
+        query = query.order_by(f"-{sort_by}" if desc else sort_by)
 
+    return await ProductPydList.from_queryset(query)
 
-    products = await query
-    return [await ProductPydantic.from_tortoise_orm(product) for product in products]
-
-@app.get("/orders/", response_model=List[OrderPydantic])
-async def list_orders():
-    orders = await Order.all()
-    return [await OrderPydantic.from_tortoise_orm(order) for order in orders]
+@app.get("/orders/", response_model=Page[OrderPyd])
+async def list_orders(
+    limit: int = Query(PAGE_LIMIT, gt=0, le=MAX_PAGE_LIMIT, description="Page size"),
+    after_id: Optional[int] = Query(None, ge=0, description="Cursor: last id of the previous page"),
+):
+    return await paginate(OrderPydList, Order.all(), limit, after_id)